@@ -18,10 +18,10 @@
 import os
 import sys
 
-from cocopye.ui import terminal
-
 
 def main() -> None:
+    from cocopye.ui import terminal
+
     try:
         terminal.main()
     except KeyboardInterrupt:
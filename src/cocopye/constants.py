@@ -15,6 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with CoCoPyE. If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
+from typing import Tuple
+
 # === HYPERPARAMETERS ==================================================================================================
 
 K = 9
@@ -27,6 +30,16 @@ RESOLUTION_COMP = {24: 8, 28: 6}
 RESOLUTION_CONT = {24: 7, 28: 12}
 """Histogram resolution for contamination"""
 
+
+@lru_cache(maxsize=None)
+def resolutions(pfam_version: int) -> Tuple[int, int]:
+    """
+    :param pfam_version: Pfam version of the database (24 or 28)
+    :return: Histogram resolutions for completeness and contamination (in this order)
+    """
+    return RESOLUTION_COMP[pfam_version], RESOLUTION_CONT[pfam_version]
+
+
 TRANSITION_1_2_MIN_COMP = 0.1
 """Minimal completeness to allow a bin to move from stage 1 to 2"""
 TRANSITION_2_3_MIN_COMP = 0.6
@@ -15,20 +15,31 @@
 # You should have received a copy of the GNU General Public License
 # along with CoCoPyE. If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import importlib.util
 import os
 import sys
 from datetime import datetime
-from typing import List, Dict
+from functools import lru_cache
+from typing import List, Dict, Iterator, Optional, Tuple
 
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
 
 from . import constants
 from .matrices import DatabaseMatrix, load_u8mat_from_file, QueryMatrix
-from .pfam import count_pfams
+from .pfam import count_pfams, bin_files
+
+# Maximal number of files in the cache folder of the database. The least recently used ones are removed first.
+_MAX_CACHE_FILES = 256
 
 
 class Result:
+    __slots__ = ("bin_id", "stage", "method", "count_ratio", "knn_scores", "taxonomy", "taxonomy_level", "notes",
+                 "comp_1_bac", "comp_1_arc", "cont_1_bac", "cont_1_arc", "comp_2", "cont_2", "num_markers_2", "comp_3",
+                 "cont_3")
+
     bin_id: str
     stage: int
     method: str
@@ -67,27 +78,129 @@ class Result:
             return self.cont_3
 
     def to_csv(self, verbosity: str = "standard") -> str:
-        output_lists = {
-            "standard": [self.bin_id, "{:.4f}".format(self.completeness()), "{:.4f}".format(self.contamination()), self.method, self.taxonomy,
-                         self.taxonomy_level, self.notes],
-            "extended": [self.bin_id, "{:.4f}".format(self.completeness()), "{:.4f}".format(self.contamination()), self.stage, self.method, self.num_markers_2,
-                         self.count_ratio, self.knn_scores, self.taxonomy, self.taxonomy_level, self.notes],
-            "full": [self.bin_id, self.stage, self.method, self.comp_1_arc, self.cont_1_arc, self.comp_1_bac, self.cont_1_bac,
-                           self.comp_2, self.cont_2, self.num_markers_2, self.comp_3, self.cont_3, self.count_ratio,
-                           self.knn_scores, self.taxonomy, self.taxonomy_level, self.notes]
+        """
+        Convert this result into a CSV line. If you want to output several results, use `Results.to_csv` or
+        `Results.write_csv`, which are faster.
+        """
+        formatted = {
+            "completeness": "{:.4f}".format(self.completeness()),
+            "contamination": "{:.4f}".format(self.contamination())
         }
-
-        return ",".join([str(item) for item in output_lists[verbosity]])
+        return ",".join([
+            formatted[column] if column in formatted else str(getattr(self, column))
+            for column in Results._CSV_COLUMNS[verbosity]
+        ])
 
     def to_web(self) -> Dict[str, str]:
         return {
             "completeness": "{:.2f}%".format(self.completeness() * 100),
             "contamination": "{:.2f}%".format(self.contamination() * 100),
-            "stage": self.stage,
+            "stage": int(self.stage),
             "taxonomy": self.taxonomy + " (" + self.taxonomy_level + ")",
         }
 
 
+class Results:
+    """
+    The results of a CoCoPyE run. All values are stored column-wise in a pandas dataframe (one row per bin, one column
+    per attribute of `Result`). Indexing or iterating over this class yields `Result` objects, which are only created
+    when they are accessed.
+    """
+    _df: pd.DataFrame
+
+    COLUMNS = list(Result.__slots__)
+
+    _CSV_COLUMNS = {
+        "standard": ["bin_id", "completeness", "contamination", "method", "taxonomy", "taxonomy_level", "notes"],
+        "extended": ["bin_id", "completeness", "contamination", "stage", "method", "num_markers_2", "count_ratio",
+                     "knn_scores", "taxonomy", "taxonomy_level", "notes"],
+        "full": ["bin_id", "stage", "method", "comp_1_arc", "cont_1_arc", "comp_1_bac", "cont_1_bac", "comp_2",
+                 "cont_2", "num_markers_2", "comp_3", "cont_3", "count_ratio", "knn_scores", "taxonomy",
+                 "taxonomy_level", "notes"]
+    }
+
+    _CSV_HEADERS = {
+        "standard": ["bin", "completeness", "contamination", "method", "taxonomy", "taxonomy_level", "notes"],
+        "extended": ["bin", "completeness", "contamination", "stage", "method", "num_markers", "coding_density",
+                     "knn_score", "taxonomy", "taxonomy_level", "notes"],
+        "full": ["bin", "stage", "method", "1_completeness_arc", "1_contamination_arc", "1_completeness_bac",
+                 "1_contamination_bac", "2_completeness", "2_contamination", "2_num_markers", "3_completeness",
+                 "3_contamination", "coding_density", "knn_score", "taxonomy", "taxonomy_level", "notes"]
+    }
+
+    def __init__(self, df: pd.DataFrame):
+        """
+        :param df: A dataframe with one column for each attribute of `Result`
+        """
+        self._df = df
+
+    def dataframe(self) -> pd.DataFrame:
+        """
+        :return: The underlying dataframe (in case you need direct access to it)
+        """
+        return self._df
+
+    def completeness(self) -> npt.NDArray[np.float64]:
+        """
+        :return: The final completeness estimate of each bin (-1 for rejected bins)
+        """
+        stage = self._df["stage"].to_numpy()
+        return np.select([stage == 1, stage == 2], [-1, self._df["comp_2"].to_numpy()], self._df["comp_3"].to_numpy())
+
+    def contamination(self) -> npt.NDArray[np.float64]:
+        """
+        :return: The final contamination estimate of each bin (-1 for rejected bins)
+        """
+        stage = self._df["stage"].to_numpy()
+        return np.select([stage == 1, stage == 2], [-1, self._df["cont_2"].to_numpy()], self._df["cont_3"].to_numpy())
+
+    def to_csv(self, verbosity: str = "standard") -> str:
+        """
+        Convert all results into CSV lines (without header). This produces the same output as calling `Result.to_csv`
+        for each bin, but converts the values column by column instead of creating a `Result` for each bin.
+
+        :param verbosity: One of standard, extended or full
+        """
+        return "".join(line + "\n" for line in self._csv_lines(verbosity))
+
+    def write_csv(self, filename: str, verbosity: str = "standard") -> None:
+        """
+        Write all results including a header line to a CSV file.
+
+        :param filename: Output file
+        :param verbosity: One of standard, extended or full
+        """
+        with open(filename, "w") as outfile:
+            outfile.write(",".join(self._CSV_HEADERS[verbosity]) + "\n")
+            outfile.writelines(line + "\n" for line in self._csv_lines(verbosity))
+
+    def _csv_lines(self, verbosity: str) -> Iterator[str]:
+        # Like Result.to_csv, the values are joined without any quoting (so the output doesn't change if a bin name
+        # contains a comma or quote character).
+        formatted = {
+            "completeness": np.char.mod("%.4f", self.completeness()),
+            "contamination": np.char.mod("%.4f", self.contamination())
+        }
+        columns = [
+            formatted[column] if column in formatted else list(map(str, self._df[column].to_numpy()))
+            for column in self._CSV_COLUMNS[verbosity]
+        ]
+        return map(",".join, zip(*columns))
+
+    def __len__(self) -> int:
+        return int(self._df.shape[0])
+
+    def __getitem__(self, idx: int) -> Result:
+        result = Result()
+        for column in self._df.columns:
+            setattr(result, column, self._df[column].to_numpy()[idx])
+        return result
+
+    def __iter__(self) -> Iterator[Result]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+
 def core(cocopye_db: str,
          uproc_orf: str,
          uproc_prot: str,
@@ -97,122 +210,347 @@ def core(cocopye_db: str,
          pfam_version: int,
          file_extensions: List[str],
          num_threads: int,
-         print_progress: bool = True
-         ) -> List[Result]:
-    pfam_version = str(pfam_version)
+         print_progress: bool = True,
+         use_cache: bool = False,
+         use_gpu: bool = False
+         ) -> Results:
+    """
+    Run the whole CoCoPyE pipeline on a folder of bins.
+
+    :param use_cache: If true, the Pfam counts of the input bins are stored in the cache subdirectory of the CoCoPyE
+    database and reused in later runs as long as the input files (name, modification time and size) did not change.
+    The same applies to the nearest neighbors, which are reused for identical Pfam counts and database. The cache keeps
+    the most recently used results only (see `_prune_cache`), and it is skipped if the database folder isn't writable.
+    :param use_gpu: Search the nearest neighbors on a CUDA GPU (requires CuPy). This is experimental: the CUDA kernel
+    has not been verified on a GPU yet, so it is not available from the command line.
+    The remaining parameters correspond to the configuration and command line options of `cocopye run`.
+    :return: The results for all bins
+    """
+    version_dir = str(pfam_version)
 
     log("Loading CoCoPyE database", print_progress)
-    db_mat = DatabaseMatrix(
-        load_u8mat_from_file(os.path.join(cocopye_db, pfam_version, "count_matrix.npz")),
-        pd.read_csv(os.path.join(cocopye_db, pfam_version, "metadata.csv"), sep=",")
-    )
+    db_mat = _load_database(cocopye_db, version_dir)
 
-    pfam_result = count_pfams(
-        uproc_orf,
-        uproc_prot,
-        os.path.join(pfam_db, pfam_version),
-        uproc_model,
-        infolder,
-        file_extensions,
-        num_threads,
-        print_progress
-    )
+    cache_file = None
+    pfam_result = None
+    if use_cache:
+        cache_file = _pfam_cache_file(cocopye_db, pfam_db, uproc_model, version_dir, infolder, file_extensions)
+        pfam_result = _load_pfam_cache(cache_file)
+        if pfam_result is not None:
+            log("Using cached Pfam counts", print_progress)
+
+    if pfam_result is None:
+        pfam_result = count_pfams(
+            uproc_orf,
+            uproc_prot,
+            os.path.join(pfam_db, version_dir),
+            uproc_model,
+            infolder,
+            file_extensions,
+            num_threads,
+            print_progress
+        )
+
+        if pfam_result is not None and cache_file is not None:
+            _save_pfam_cache(cache_file, *pfam_result)
 
     if pfam_result is None:
         print("\nError: No input file with extensions " + str(file_extensions) + " found.")
         print("You can use --file-extension to specify a different one. Exiting.")
         sys.exit(1)
 
-    query_mat, bin_ids, count_ratio = pfam_result
+    count_mat, bin_ids, count_ratio = pfam_result
 
     log("Determining nearest neighbors", print_progress)
-    query_mat = QueryMatrix(query_mat).with_database(db_mat, constants.K)
+    knn = None
+    knn_cache_file = None
+    if use_cache:
+        knn_cache_file = _knn_cache_file(cocopye_db, version_dir, count_mat, constants.K)
+        knn = _load_knn_cache(knn_cache_file)
+
+    query_mat = QueryMatrix(count_mat).with_database(db_mat, constants.K, knn, use_gpu)
+    knn_result = query_mat.knn()
+    knn_scores = query_mat.knn_scores()
+    assert knn_result is not None and knn_scores is not None
+
+    if knn is None and knn_cache_file is not None:
+        _save_knn_cache(knn_cache_file, knn_result[1], knn_scores)
 
     assert len(bin_ids) == query_mat.mat().shape[0]
 
     log("Calculating preestimates", print_progress)
-    universal_arc = np.load(
-        os.path.join(cocopye_db, pfam_version, "universal_Archaea.npy"))
-    universal_bac = np.load(
-        os.path.join(cocopye_db, pfam_version, "universal_Bacteria.npy"))
+    universal_arc = _load_universal_markers(cocopye_db, version_dir, "Archaea")
+    universal_bac = _load_universal_markers(cocopye_db, version_dir, "Bacteria")
 
-    preestimates_arc = query_mat.preestimates(universal_arc)
-    preestimates_bac = query_mat.preestimates(universal_bac)
+    preestimates_arc, preestimates_bac = query_mat.preestimates_batch([universal_arc, universal_bac])
 
     estimates = query_mat.estimates(print_progress=print_progress, frac_eq=constants.FRAC_EQ)
+    assert estimates is not None
 
     log("Calculating ML estimates", print_progress)
-    feature_mat_comp = query_mat.into_feature_mat(estimates, constants.RESOLUTION_COMP[int(pfam_version)])
-    feature_mat_cont = query_mat.into_feature_mat(estimates, constants.RESOLUTION_CONT[int(pfam_version)])
+    resolution_comp, resolution_cont = constants.resolutions(pfam_version)
+    feature_mats = query_mat.into_feature_mats(estimates, [resolution_comp, resolution_cont])
+    assert feature_mats is not None
+    feature_mat_comp, feature_mat_cont = feature_mats
 
-    ml_estimates_comp = feature_mat_comp.ml_estimates(
-        os.path.join(cocopye_db, pfam_version, "model_comp.pickle")).clip(0, 1)
-    ml_estimates_cont = feature_mat_cont.ml_estimates(
-        os.path.join(cocopye_db, pfam_version, "model_cont.pickle")).clip(0, 1000000)
+    ml_estimates_comp = feature_mat_comp.ml_estimates(os.path.join(cocopye_db, version_dir, "model_comp.pickle"))
+    ml_estimates_cont = feature_mat_cont.ml_estimates(os.path.join(cocopye_db, version_dir, "model_cont.pickle"))
+    np.clip(ml_estimates_comp, 0, 1, out=ml_estimates_comp)
+    np.clip(ml_estimates_cont, 0, 1000000, out=ml_estimates_cont)
 
     log("Processing results", print_progress)
     taxonomy = query_mat.taxonomy()
-    knn_scores = query_mat.knn_scores()
+    assert taxonomy is not None
 
-    completeness = []
-    contamination = []
-    stage = []
-    for idx in range(len(bin_ids)):
-        stage.append(1)
-        if preestimates_bac[idx, 0] > preestimates_arc[idx, 0]:
-            completeness.append(preestimates_bac[idx, 0])
-            contamination.append(preestimates_bac[idx, 1])
-        else:
-            completeness.append(preestimates_arc[idx, 0])
-            contamination.append(preestimates_arc[idx, 1])
+    # Stage 1 uses the preestimate of the superkingdom with the higher completeness. The transitions are written as
+    # negated "less than" checks so that NaN values behave exactly like in a scalar if/continue cascade.
+    preestimates = np.where(
+        (preestimates_bac[:, 0] > preestimates_arc[:, 0])[:, None], preestimates_bac, preestimates_arc
+    )
 
-        if completeness[idx] < constants.TRANSITION_1_2_MIN_COMP:
-            continue
+    stage = np.ones(len(bin_ids), dtype=np.int8)
+    stage[~(preestimates[:, 0] < constants.TRANSITION_1_2_MIN_COMP)] = 2
+    stage[(stage == 2) & ~((estimates[:, 0] < constants.TRANSITION_2_3_MIN_COMP)
+                           | (estimates[:, 1] > constants.TRANSITION_2_3_MIN_CONT))] = 3
+
+    # Currently we do not have any additional notes. But at least we could add some if we want.
+    notes = [""] * len(bin_ids)
+
+    return Results(pd.DataFrame({
+        "bin_id": bin_ids,
+        "stage": stage,
+        "method": np.array(["rejected", "markers", "markers + neural network"])[stage - 1],
+        "count_ratio": count_ratio,
+        "knn_scores": knn_scores,
+        "taxonomy": [tax[0] for tax in taxonomy],
+        "taxonomy_level": [tax[1] for tax in taxonomy],
+        "notes": notes,
+        "comp_1_bac": preestimates_bac[:, 0],
+        "comp_1_arc": preestimates_arc[:, 0],
+        "cont_1_bac": preestimates_bac[:, 1],
+        "cont_1_arc": preestimates_arc[:, 1],
+        "comp_2": estimates[:, 0],
+        "cont_2": estimates[:, 1],
+        "num_markers_2": estimates[:, 2],
+        "comp_3": ml_estimates_comp,
+        "cont_3": ml_estimates_cont
+    }))
+
+
+def _load_database(cocopye_db: str, pfam_version: str) -> DatabaseMatrix:
+    count_file = _uncompressed_count_file(os.path.join(cocopye_db, pfam_version, "count_matrix.npz"))
+
+    # A Parquet version of the metadata is much faster to read, but the CSV file is still supported.
+    metadata_file = os.path.join(cocopye_db, pfam_version, "metadata.parquet")
+    if not os.path.isfile(metadata_file) or importlib.util.find_spec("pyarrow") is None:
+        metadata_file = os.path.join(cocopye_db, pfam_version, "metadata.csv")
+
+    # The modification times are part of the cache key, so an updated database is loaded again.
+    return _load_database_cached(
+        count_file, os.path.getmtime(count_file), metadata_file, os.path.getmtime(metadata_file)
+    )
 
-        stage[idx] = 2
-        completeness[idx] = estimates[idx, 0]
-        contamination[idx] = estimates[idx, 1]
 
-        if completeness[idx] < constants.TRANSITION_2_3_MIN_COMP or contamination[idx] > constants.TRANSITION_2_3_MIN_CONT:
-            continue
+@lru_cache(maxsize=4)
+def _load_database_cached(
+        count_file: str,
+        _count_mtime: float,
+        metadata_file: str,
+        _metadata_mtime: float
+) -> DatabaseMatrix:
+    count_mat = load_u8mat_from_file(count_file, mmap_mode="r")
+    count_mat.setflags(write=False)  # The same matrix is returned by every call
 
-        stage[idx] = 3
-        completeness[idx] = ml_estimates_comp[idx]
-        contamination[idx] = ml_estimates_cont[idx]
+    count_mat_column_major = None
+    if count_file.endswith(".npy"):
+        column_major_file = _column_major_count_file(count_file, count_mat)
+        if column_major_file is not None:
+            count_mat_column_major = np.load(column_major_file, mmap_mode="r")
 
-    notes = []
-    for idx in range(len(bin_ids)):
-        # Currently we do not have any additional notes. But at least we could add some if we want.
-        notes.append("")
+    if metadata_file.endswith(".parquet"):
+        metadata = pd.read_parquet(metadata_file, engine="pyarrow")
+    else:
+        metadata = pd.read_csv(metadata_file, sep=",")
+
+    return DatabaseMatrix(count_mat, metadata, count_mat_column_major)
+
+
+def _uncompressed_count_file(npz_file: str) -> str:
+    """
+    The count matrix is distributed as compressed .npz file, which has to be decompressed completely every time it is
+    loaded. On first use we therefore store an uncompressed .npy copy next to it, which can be memory-mapped instead
+    (so only the pages that are actually needed are read, and they stay in the page cache across runs and processes).
+    If the copy can't be written (e.g. read-only database folder), the .npz file is used as before.
+    """
+    npy_file = npz_file[:-len(".npz")] + ".npy"
+    if os.path.isfile(npy_file) and os.path.getmtime(npy_file) >= os.path.getmtime(npz_file):
+        return npy_file
+
+    tmp_file = npy_file + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            np.save(f, load_u8mat_from_file(npz_file))
+        # Atomic, so that other processes never see a partially written file
+        os.replace(tmp_file, npy_file)
+    except OSError:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        return npz_file
+
+    return npy_file
+
+
+def _column_major_count_file(npy_file: str, count_mat: npt.NDArray[np.uint8], block_size: int = 4096) -> Optional[str]:
+    """
+    The nearest neighbor search needs the count matrix in column-major order. Like the uncompressed count matrix, this
+    version is stored next to it on first use and memory-mapped, so that it doesn't need an additional in-memory copy
+    of the whole matrix. It is written in blocks of rows for the same reason. Returns None if the file can't be
+    written (the DatabaseMatrix then creates a temporary copy for each search).
+    """
+    column_major_file = npy_file[:-len(".npy")] + "_column_major.npy"
+    if os.path.isfile(column_major_file) and os.path.getmtime(column_major_file) >= os.path.getmtime(npy_file):
+        return column_major_file
+
+    tmp_file = column_major_file + "." + str(os.getpid()) + ".tmp"
+    try:
+        out = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.uint8, shape=count_mat.shape, fortran_order=True)
+        for start in range(0, count_mat.shape[0], block_size):
+            out[start:start + block_size] = count_mat[start:start + block_size]
+        out.flush()
+        del out
+        # See _uncompressed_count_file
+        os.replace(tmp_file, column_major_file)
+    except OSError:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        return None
+
+    return column_major_file
+
+
+def _load_universal_markers(cocopye_db: str, pfam_version: str, superkingdom: str) -> npt.NDArray[np.uint32]:
+    marker_file = os.path.join(cocopye_db, pfam_version, "universal_" + superkingdom + ".npy")
+    return _load_universal_markers_cached(marker_file, os.path.getmtime(marker_file))
+
+
+@lru_cache(maxsize=8)
+def _load_universal_markers_cached(marker_file: str, _mtime: float) -> npt.NDArray[np.uint32]:
+    # Memory-mapped read-only, since the same array is returned by every call
+    markers: npt.NDArray[np.uint32] = np.load(marker_file, mmap_mode="r")
+    return markers
+
+
+def _pfam_cache_file(
+        cocopye_db: str,
+        pfam_db: str,
+        uproc_model: str,
+        pfam_version: str,
+        infolder: str,
+        file_extensions: List[str]
+) -> str:
+    checksum = hashlib.blake2b(digest_size=20)
+    checksum.update((pfam_version + "\0").encode())
+
+    # The counts also depend on the UProC Pfam database and models, so an update of these invalidates the cache.
+    for folder in [os.path.join(pfam_db, pfam_version), uproc_model]:
+        checksum.update((os.path.abspath(folder) + "\0").encode())
+        if os.path.isdir(folder):
+            for file in sorted(os.listdir(folder)):
+                checksum.update(_file_signature(folder, file))
+
+    for file in sorted(bin_files(infolder, file_extensions)):
+        checksum.update(_file_signature(infolder, file))
+
+    return os.path.join(cocopye_db, "cache", checksum.hexdigest() + ".npz")
+
+
+def _file_signature(folder: str, file: str) -> bytes:
+    path = os.path.join(folder, file)
+    return (file + "\0" + str(os.path.getmtime(path)) + "\0" + str(os.path.getsize(path)) + "\0").encode()
+
+
+def _load_pfam_cache(cache_file: str) -> Optional[Tuple[npt.NDArray[np.uint8], List[str], List[float]]]:
+    if not os.path.isfile(cache_file):
+        return None
+
+    _touch_cache_file(cache_file)
+    with np.load(cache_file) as cache:
+        return cache["count_mat"], cache["bin_ids"].tolist(), cache["count_ratio"].tolist()
+
+
+def _save_pfam_cache(
+        cache_file: str,
+        count_mat: npt.NDArray[np.uint8],
+        bin_ids: List[str],
+        count_ratio: List[float]
+) -> None:
+    _write_cache_file(
+        cache_file,
+        count_mat=count_mat,
+        bin_ids=np.array(bin_ids, dtype=str),
+        count_ratio=np.array(count_ratio, dtype=np.float64)
+    )
+
+
+def _knn_cache_file(cocopye_db: str, pfam_version: str, query_mat: npt.NDArray[np.uint8], k: int) -> str:
+    count_file = os.path.join(cocopye_db, pfam_version, "count_matrix.npz")
+
+    checksum = hashlib.blake2b(digest_size=20)
+    checksum.update(("knn\0" + pfam_version + "\0" + str(os.path.getmtime(count_file)) + "\0" + str(k) + "\0").encode())
+    checksum.update(str(query_mat.shape).encode())
+    checksum.update(np.ascontiguousarray(query_mat).data)
+
+    return os.path.join(cocopye_db, "cache", "knn_" + checksum.hexdigest() + ".npz")
 
-    results = []
-    for idx in range(len(bin_ids)):
-        result = Result()
 
-        result.bin_id = bin_ids[idx]
-        result.stage = stage[idx]
-        result.method = ["rejected", "markers", "markers + neural network"][stage[idx] - 1]
-        result.count_ratio = count_ratio[idx]
-        result.knn_scores = knn_scores[idx]
-        result.taxonomy = taxonomy[idx][0]
-        result.taxonomy_level = taxonomy[idx][1]
-        result.notes = notes[idx]
+def _load_knn_cache(cache_file: str) -> Optional[Tuple[npt.NDArray[np.uint32], npt.NDArray[np.float32]]]:
+    if not os.path.isfile(cache_file):
+        return None
 
-        result.comp_1_bac = preestimates_bac[idx, 0]
-        result.comp_1_arc = preestimates_arc[idx, 0]
-        result.cont_1_bac = preestimates_bac[idx, 1]
-        result.cont_1_arc = preestimates_arc[idx, 1]
+    _touch_cache_file(cache_file)
+    with np.load(cache_file) as cache:
+        return cache["knn_inds"], cache["knn_scores"]
 
-        result.comp_2 = estimates[idx, 0]
-        result.cont_2 = estimates[idx, 1]
-        result.num_markers_2 = estimates[idx, 2]
 
-        result.comp_3 = ml_estimates_comp[idx]
-        result.cont_3 = ml_estimates_cont[idx]
+def _save_knn_cache(cache_file: str, knn_inds: npt.NDArray[np.uint32], knn_scores: npt.NDArray[np.float32]) -> None:
+    _write_cache_file(cache_file, knn_inds=knn_inds, knn_scores=knn_scores)
 
-        results.append(result)
 
-    return results
+def _write_cache_file(cache_file: str, **arrays: npt.ArrayLike) -> None:
+    # Write to a temporary file first, so that an interrupted run never leaves a truncated cache file behind. If the
+    # cache can't be written (e.g. read-only database folder), the run simply continues without caching.
+    tmp_file = cache_file + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp_file, "wb") as f:
+            np.savez_compressed(f, allow_pickle=False, **arrays)
+        os.replace(tmp_file, cache_file)
+        _prune_cache(os.path.dirname(cache_file))
+    except OSError:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+
+def _touch_cache_file(cache_file: str) -> None:
+    # The modification time of a cache file is its last use, which decides what _prune_cache removes first
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+
+
+def _prune_cache(cache_dir: str, max_files: int = _MAX_CACHE_FILES) -> None:
+    """
+    Remove the least recently used cache files, so that at most `max_files` remain in the cache folder.
+    """
+    cache_files = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".npz") and entry.is_file()]
+    cache_files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+    for entry in cache_files[max_files:]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
 
 
 def log(message: str, show: bool = True):
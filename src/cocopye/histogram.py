@@ -15,8 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with CoCoPyE. If not, see <https://www.gnu.org/licenses/>.
 
+from typing import Union
+
 import numpy as np
 import numpy.typing as npt
+from numba import njit
 
 _MAX_COUNT = 255
 
@@ -26,7 +29,7 @@ class Histogram:
     A Histogram class that is used for the transformation of a `cocopye.matrices.QueryMatrix` into a
     `cocopye.matrices.FeatureMatrix`.
     """
-    _indx_mat: npt.NDArray[np.int32]
+    _indx_mat: npt.NDArray[Union[np.int8, np.int16]]
     _n_histogram_bins: int
 
     def __init__(self, resolution: int):
@@ -58,13 +61,63 @@ class Histogram:
 
         :return: Histogram bins as numpy array
         """
-        # clip to maximum count (255 for uint8)!
-        # use both count vectors as indices
-        # indvec contains all the ratio possitions for both count vect that would be in edge_vec
-        ind_vec = self._indx_mat[np.clip(in_vec, 0, _MAX_COUNT), np.clip(neighbor_vec, 0, _MAX_COUNT)]
-        # histogram counts for all bins
-        x_new_vec = np.bincount(ind_vec[ind_vec != -1], minlength=self._n_histogram_bins)
-        return x_new_vec
+        return self.calc_bins_for_neighbor_block(in_vec, neighbor_vec)
+
+    def calc_bins_for_neighbor_block(
+            self, in_vec: npt.NDArray[np.uint8],
+            neighbor_block: npt.NDArray[np.uint8]
+    ) -> npt.NDArray[np.int64]:
+        """
+        Calculate the bins for a vector and several other vectors at once (usually Pfam counts of a query and its
+        nearest neighbors). The result is the sum of the histograms of all pairs, so the mean histogram is simply the
+        result divided by the number of neighbors.
+
+        :param in_vec: first (query) vector
+        :param neighbor_block: Matrix with one (neighbor) vector per row. A single vector is also accepted.
+
+        :return: Histogram bins (summed over all neighbors) as numpy array
+        """
+        # clip to maximum count (255 for uint8)! (not necessary if the counts already are uint8)
+        in_vec = _clip_counts(in_vec)
+        neighbor_block = _clip_counts(neighbor_block)
+        # use both count vectors as indices and count the histogram bins directly (without temporary index arrays)
+        return _count_bins(self._indx_mat, in_vec, np.atleast_2d(neighbor_block), self._n_histogram_bins)
+
+    def index_matrix(self) -> npt.NDArray[Union[np.int8, np.int16]]:
+        """
+        :return: The lookup table (256 x 256) that maps a pair of counts to the index of its histogram bin. The entry
+        for 0/0 is -1, since this is not an admissible count ratio.
+        """
+        return self._indx_mat
+
+    def num_bins(self) -> int:
+        """
+        :return: Number of histogram bins
+        """
+        return self._n_histogram_bins
+
+
+@njit(cache=True)
+def _count_bins(
+        indx_mat: npt.NDArray[Union[np.int8, np.int16]],
+        in_vec: npt.NDArray[np.uint8],
+        neighbor_block: npt.NDArray[np.uint8],
+        n_histogram_bins: int
+) -> npt.NDArray[np.int64]:
+    result = np.zeros(n_histogram_bins, dtype=np.int64)
+    for row in range(neighbor_block.shape[0]):
+        for col in range(in_vec.shape[0]):
+            ind = indx_mat[in_vec[col], neighbor_block[row, col]]
+            # 0/0 is not an admissible count ratio
+            if ind != -1:
+                result[ind] += 1
+    return result
+
+
+def _clip_counts(counts: npt.NDArray[np.uint8]) -> npt.NDArray[np.uint8]:
+    if counts.dtype == np.uint8:
+        return counts
+    return np.clip(counts, 0, _MAX_COUNT)
 
 
 def _calc_cr_hist_edges(resolution: int) -> npt.NDArray[np.float32]:
@@ -90,25 +143,23 @@ def _calc_cr_hist_edges(resolution: int) -> npt.NDArray[np.float32]:
     return edge_vec
 
 
-def _calc_index_matrix(edge_vec: npt.NDArray[np.float32], n_histogram_bins: int) -> npt.NDArray[np.int32]:
+def _calc_index_matrix(
+        edge_vec: npt.NDArray[np.float32],
+        n_histogram_bins: int
+) -> npt.NDArray[Union[np.int8, np.int16]]:
     # using 2D index table (256 x 256)!
-    indx_mat = np.zeros((_MAX_COUNT + 1, _MAX_COUNT + 1), dtype=np.int32)
+    # the smallest signed type that can hold all bin indices (and -1) keeps the table small enough for the CPU cache
+    dtype = np.int8 if n_histogram_bins <= np.iinfo(np.int8).max + 1 else np.int16
+    indx_mat = np.zeros((_MAX_COUNT + 1, _MAX_COUNT + 1), dtype=dtype)
     # contains all ratios of 1-255 to 1-255
     # 1/1,  1/2,    1/3     ....    1/255
     # 2/1,  2/2,    2/3     ....    2/255
     # ...
     # 255/1,255/2,  255/3   ....  255/255
-    cr_list = [i / j for i in range(1, _MAX_COUNT + 1)
-               for j in range(1, _MAX_COUNT + 1)]
-    # list of i and j indicies that belong to the same positions in ratios in cr_list
-    cr_inds = [(i, j) for i in range(1, _MAX_COUNT + 1)
-               for j in range(1, _MAX_COUNT + 1)]
-    # tell us where in edge_vec to entries from cr_list need to go
-    ind_vec = np.searchsorted(edge_vec, cr_list)
-    for ind, val in enumerate(cr_list):
-        i, j = cr_inds[ind]
-        # tells us vor each count pair i and j with bin belongs to them
-        indx_mat[i, j] = ind_vec[ind]
+    counts = np.arange(1, _MAX_COUNT + 1, dtype=np.float64)
+    cr_mat = counts[:, None] / counts[None, :]
+    # tells us vor each count pair i and j with bin belongs to them
+    indx_mat[1:, 1:] = np.searchsorted(edge_vec, cr_mat)
 
     indx_mat[:, 0] = n_histogram_bins - 1  # last histogram bin (index)
     # 0/0 is not an admissible count ratio -> provoke index error!
@@ -32,19 +32,25 @@ neural network.
 
 from __future__ import annotations
 
+import os
 import pickle
 from datetime import datetime
-from typing import TypeVar, Generic, cast, Tuple, Optional, List
+from functools import lru_cache
+from typing import TypeVar, Generic, cast, Tuple, Optional, List, Dict, Union, Literal, Protocol
 import numpy as np
 import numpy.typing as npt
 from numba_progress import ProgressBar
 import pandas as pd
 
 from ..histogram import Histogram
-from ._numba_functions import nearest_neighbors_idx_njit, nearest_neighbors_idx_njit_mat, estimates_njit, estimate_njit
+from ._numba_functions import nearest_neighbors_idx_njit, nearest_neighbors_idx_njit_mat, estimates_njit, estimate_njit, \
+    feature_mats_njit, count_ones_per_col_njit, preestimates_njit, knn_from_eq_counts_njit, row_norms_njit, \
+    taxonomy_njit
 
 T = TypeVar("T")
 
+TAXONOMIC_RANKS = ["species", "genus", "family", "order", "class", "phylum", "superkingdom"]
+
 
 class Matrix(Generic[T]):
     """
@@ -95,16 +101,32 @@ class DatabaseMatrix(Matrix[npt.NDArray[np.uint8]]):
     A two-dimensional matrix containing Pfam counts. It can optionally contain metadata about the underlying sequences.
     """
     _metadata: Optional[pd.DataFrame] = None
+    _mat_column_major: Optional[npt.NDArray[np.uint8]] = None
+    _ones_per_col: Optional[npt.NDArray[np.int64]] = None
+    _row_norms: Optional[npt.NDArray[np.float64]] = None
+    _mat_gpu: Optional[object] = None
+    _taxonomy_codes: Optional[Tuple[npt.NDArray[np.int32], List[npt.NDArray[np.object_]]]] = None
 
-    def __init__(self, mat: npt.NDArray[np.uint8], metadata: Optional[pd.DataFrame] = None):
+    def __init__(
+            self,
+            mat: npt.NDArray[np.uint8],
+            metadata: Optional[pd.DataFrame] = None,
+            mat_column_major: Optional[npt.NDArray[np.uint8]] = None
+    ):
         """
         :param mat: 2-dimensional numpy matrix. Each row contains the counts of a reference sequences while each column
         represents a Pfam.
         :param metadata: A Pandas dataframe containing metadata for each reference sequence. It is expected that the
         same row indices of the matrix and metadata represent the same sequence.
+        :param mat_column_major: The same matrix in column-major (Fortran) order, e.g. memory-mapped from a file (see
+        `mat_column_major`).
         """
         super().__init__(mat)
         self._metadata = metadata
+        if mat_column_major is not None:
+            assert mat_column_major.shape == mat.shape and mat_column_major.flags.f_contiguous, \
+                "mat_column_major has to be a column-major version of mat"
+            self._mat_column_major = mat_column_major
 
     def metadata(self) -> Optional[pd.DataFrame]:
         """
@@ -113,6 +135,58 @@ class DatabaseMatrix(Matrix[npt.NDArray[np.uint8]]):
         """
         return self._metadata
 
+    def taxonomy_codes(self) -> Optional[Tuple[npt.NDArray[np.int32], List[npt.NDArray[np.object_]]]]:
+        """
+        :return: The taxonomy of the metadata in factorized form (or None if there is no metadata). The first element is
+        a matrix with one row per reference and one column per rank in `TAXONOMIC_RANKS`, containing an integer code
+        for each taxon (-1 for missing values). The second element contains the taxon names for each rank, indexed by
+        these codes. This is calculated on first use and then kept.
+        """
+        if self._metadata is None:
+            return None
+
+        if self._taxonomy_codes is None:
+            codes = np.empty((self._mat.shape[0], len(TAXONOMIC_RANKS)), dtype=np.int32)
+            names = []
+            for idx, rank in enumerate(TAXONOMIC_RANKS):
+                rank_codes, rank_names = pd.factorize(self._metadata[rank])
+                codes[:, idx] = rank_codes
+                names.append(np.asarray(rank_names, dtype=object))
+            self._taxonomy_codes = codes, names
+
+        return self._taxonomy_codes
+
+    def mat_column_major(self) -> npt.NDArray[np.uint8]:
+        """
+        :return: The matrix in column-major (Fortran) order, which is used for the nearest neighbor search. If it wasn't
+        passed to the constructor, a temporary copy is created on every call. This copy is not kept, since it would
+        need as much memory as the (possibly memory-mapped) matrix itself for the lifetime of the DatabaseMatrix.
+        """
+        if self._mat_column_major is not None:
+            return self._mat_column_major
+        return np.asfortranarray(self._mat)
+
+    def mat_gpu(self) -> object:
+        """
+        :return: A copy of the matrix in column-major order in GPU memory (a CuPy array), which is used for the nearest
+        neighbor search on the GPU. It is created on first use and then kept, so the matrix is only transferred once.
+        This requires CuPy.
+        """
+        if self._mat_gpu is None:
+            import cupy
+            self._mat_gpu = cupy.asfortranarray(cupy.asarray(self.mat_column_major()))
+        return self._mat_gpu
+
+    def row_norms(self) -> npt.NDArray[np.float64]:
+        """
+        :return: The square root of the number of nonzero counts of each reference, which is used to normalize the
+        nearest neighbor scores. It is calculated on first use and then kept, so it isn't recalculated for every query.
+        """
+        if self._row_norms is None:
+            self._row_norms = row_norms_njit(self._mat)
+            self._row_norms.setflags(write=False)
+        return self._row_norms
+
     def nearest_neighbors(self, vec: npt.NDArray[np.uint8], k: int) -> DatabaseMatrix:
         """
         Returns the k nearest neighbors of a vector in the database matrix.
@@ -133,7 +207,7 @@ class DatabaseMatrix(Matrix[npt.NDArray[np.uint8]]):
 
         :return: A numpy array containing the indices of the nearest neighbors.
         """
-        return nearest_neighbors_idx_njit(self._mat, vec, k)[0]
+        return nearest_neighbors_idx_njit(self._mat, vec, k, self.row_norms())[0]
 
     def universal_markers(self, threshold: float = 0.95) -> npt.NDArray[np.uint32]:
         """
@@ -144,14 +218,18 @@ class DatabaseMatrix(Matrix[npt.NDArray[np.uint8]]):
 
         :return: The (column) indices of possible universal markers
         """
-        return np.where(np.count_nonzero(self._mat == 1, axis=0) / self._mat.shape[0] >= threshold)[0]
+        # The counts don't depend on the threshold, so they are calculated only once
+        if self._ones_per_col is None:
+            self._ones_per_col = count_ones_per_col_njit(self._mat)
+
+        return np.where(self._ones_per_col / self._mat.shape[0] >= threshold)[0]
 
     def estimate(
             self,
             vec: npt.NDArray[np.uint8],
             k: int,
             frac_eq: float = 1.0,
-            knn_inds: Optional[npt.NDArray[np.uint64]] = None
+            knn_inds: Optional[npt.NDArray[np.uint32]] = None
     ) -> Tuple[float, float, int]:
         """
         Calculate an estimate for completeness and contamination for a vector based on common markers in the k nearest
@@ -166,6 +244,8 @@ class DatabaseMatrix(Matrix[npt.NDArray[np.uint8]]):
         (both between 0 and 1) and the third one is the number of markers that were used. (The last value is mainly
         intended for evaluation purposes.)
         """
+        if knn_inds is None:
+            knn_inds = self.nearest_neighbors_idx(vec, k).astype(np.uint32)
         return estimate_njit(self.mat(), vec, k, frac_eq, knn_inds)
 
 
@@ -176,8 +256,9 @@ class QueryMatrix(Matrix[npt.NDArray[np.uint8]]):
     """
     _db_mat: Optional[npt.NDArray[np.uint8]] = None
     _db_metadata: Optional[pd.DataFrame] = None
+    _db_taxonomy_codes: Optional[Tuple[npt.NDArray[np.int32], List[npt.NDArray[np.object_]]]] = None
     _k: Optional[int] = None
-    _knn_inds: Optional[npt.NDArray[np.uint64]] = None
+    _knn_inds: Optional[npt.NDArray[np.uint32]] = None
     _knn_scores: Optional[npt.NDArray[np.float32]] = None
 
     def __init__(self, mat: npt.NDArray[np.uint8]):
@@ -187,31 +268,54 @@ class QueryMatrix(Matrix[npt.NDArray[np.uint8]]):
         """
         super().__init__(mat)
 
-    def with_database(self, db: DatabaseMatrix, k: Optional[int] = None) -> QueryMatrix:
+    def with_database(
+            self,
+            db: DatabaseMatrix,
+            k: Optional[int] = None,
+            knn: Optional[Tuple[npt.NDArray[np.uint32], npt.NDArray[np.float32]]] = None,
+            use_gpu: bool = False
+    ) -> QueryMatrix:
         """
         Add a DatabaseMatrix. This is required for almost all other functions of this class.
 
         :param db: DatabaseMatrix to be added.
         :param k: If provided, the function calculates and stores the k nearest neighbors for each query sequence. This
         is required for functions like estimates or taxonomy.
+        :param knn: Previously calculated nearest neighbor indices and scores for the same query and database matrix
+        (see `knn` and `knn_scores`). If provided, they are used instead of searching the database again. This requires
+        k. If they don't match the query matrix, database and k, the nearest neighbors are calculated again.
+        :param use_gpu: Search the nearest neighbors on a CUDA GPU. This requires CuPy. The results should be the same
+        as on the CPU (see tests/test_gpu.py), but this is experimental: the CUDA kernel has not been verified on a GPU
+        yet.
         """
         self._db_mat = db.mat()
         self._db_metadata = db.metadata()
+        self._db_taxonomy_codes = db.taxonomy_codes()
 
         if k is not None:
+            # There can't be more neighbors than database entries
+            k = min(k, db.mat().shape[0])
             self._k = k
-            self._knn_inds, self._knn_scores = nearest_neighbors_idx_njit_mat(self._db_mat, self._mat, self._k)
+            if knn is not None and knn[0].shape == (self._mat.shape[0], k) and knn[1].shape == (self._mat.shape[0],) \
+                    and int(knn[0].max(initial=0)) < db.mat().shape[0]:
+                self._knn_inds, self._knn_scores = knn
+            elif use_gpu:
+                self._knn_inds, self._knn_scores = _nearest_neighbors_cupy(db, self._mat, self._k)
+            else:
+                self._knn_inds, self._knn_scores = nearest_neighbors_idx_njit_mat(
+                    db.mat_column_major(), self._mat, self._k, db.row_norms()
+                )
 
         return self
 
-    def knn(self) -> Optional[Tuple[int, npt.NDArray[np.uint64]]]:
+    def knn(self) -> Optional[Tuple[int, npt.NDArray[np.uint32]]]:
         """
         Return the previously calculated nearest neighbors. This requires a database matrix with k not None.
 
         :return: A Tuple containing the number of nearest neighbors as well as their indices. Returns None if this
         QueryMatrix doesn't contain any information about nearest neighbors.
         """
-        if self._k is None:
+        if self._k is None or self._knn_inds is None:
             return None
 
         return self._k, self._knn_inds
@@ -237,12 +341,17 @@ class QueryMatrix(Matrix[npt.NDArray[np.uint8]]):
         :return: A two-dimensional numpy array. Each row contains two values which are (in this order) the completeness
         and the contamination estimate for the respective query bin.
         """
-        submatrix = self._mat[:, markers]
+        return self.preestimates_batch([markers])[0]
 
-        completeness = np.sum(np.clip(submatrix, 0, 1), axis=1) / markers.shape[0]
-        contamination = np.sum(submatrix - np.clip(submatrix, 0, 1), axis=1) / markers.shape[0]
+    def preestimates_batch(self, markers_list: List[npt.NDArray[np.uint32]]) -> List[npt.NDArray[np.float32]]:
+        """
+        Calculate preestimates for several sets of universal markers (e.g. Archaea and Bacteria) at once.
+
+        :param markers_list: A list of arrays containing (column) indices that will be used as markers
 
-        return np.array([completeness, contamination], dtype=np.float32).T
+        :return: A list containing one result of `preestimates` for each marker set (in the same order)
+        """
+        return [preestimates_njit(self._mat, markers) for markers in markers_list]
 
     def estimates(
             self,
@@ -261,7 +370,7 @@ class QueryMatrix(Matrix[npt.NDArray[np.uint8]]):
         :return: A 2-dimensional numpy array. For each row in the QueryMatrix there is a row with two floats, where the
         first element ist the completeness and the second one the contamination estimate.
         """
-        if self._db_mat is None:
+        if self._db_mat is None or self._knn_inds is None:
             return None
 
         with ProgressBar(
@@ -281,51 +390,54 @@ class QueryMatrix(Matrix[npt.NDArray[np.uint8]]):
 
         :return: A list of strings representing taxonomy estimates, one for each query bin.
         """
-        if self._db_metadata is None:
+        if self._db_taxonomy_codes is None or self._knn_inds is None:
             return None
 
-        metadata = self._db_metadata
-        results = []
+        codes, names = self._db_taxonomy_codes
+        consensus = taxonomy_njit(codes, self._knn_inds)
 
-        for knn in self._knn_inds:
-            found = False
-            knn_meta = metadata.iloc[knn]
-            for col in ["species", "genus", "family", "order", "class", "phylum", "superkingdom"]:
-                if knn_meta[col].isna().any():
-                    continue
-                if np.unique(knn_meta[col].to_numpy()).shape[0] == 1:
-                    results.append((knn_meta.iloc[0][col], col))
-                    found = True
-                    break
-            if not found:
-                results.append(("-", "-"))
-
-        return results
+        return [
+            ("-", "-") if rank == -1 else (names[rank][code], TAXONOMIC_RANKS[rank])
+            for code, rank in consensus
+        ]
 
     def into_feature_mat(
             self,
             estimates: npt.NDArray[np.float32],
             resolution: int = 10
     ) -> Optional[FeatureMatrix]:
-        if self._knn_inds is None:
-            return None
+        feature_mats = self.into_feature_mats(estimates, [resolution])
+        return None if feature_mats is None else feature_mats[0]
 
-        hist = Histogram(resolution)
+    def into_feature_mats(
+            self,
+            estimates: npt.NDArray[np.float32],
+            resolutions: List[int]
+    ) -> Optional[List[FeatureMatrix]]:
+        """
+        Calculate feature matrices for several histogram resolutions at once. This is faster than calling
+        `into_feature_mat` for each resolution, because the neighbors of each query are only processed once.
 
-        feature_vecs = []
-        for idx, row in enumerate(self._mat):
-            knn_mat = self._db_mat[self._knn_inds[idx]]
+        :param estimates: Estimates as returned by `estimates`
+        :param resolutions: List of histogram resolutions
 
-            knn_hists = []
-            for neighbor in knn_mat:
-                knn_hists.append(hist.calc_bins_for_two_counts(row, neighbor))
+        :return: One FeatureMatrix for each resolution (in the same order) or None if the QueryMatrix has no database
+        """
+        if self._knn_inds is None or self._db_mat is None:
+            return None
 
-            mean_hist = np.mean(np.array(knn_hists), axis=0)
-            mean_hist = mean_hist / np.sum(mean_hist)
+        hists = [Histogram(resolution) for resolution in resolutions]
+        n_bins = np.array([hist.num_bins() for hist in hists])
 
-            feature_vecs.append(np.concatenate([mean_hist, estimates[idx, :2]]))
+        # The counts are used as indices into the lookup tables (256 x 256), so they have to be uint8
+        assert self._mat.dtype == np.uint8 and self._db_mat.dtype == np.uint8, "Count matrices have to be uint8"
 
-        return FeatureMatrix(np.array(feature_vecs))
+        feature_mats = feature_mats_njit(
+            self._mat, self._db_mat, self._knn_inds, estimates.astype(np.float64, copy=False),
+            np.stack([hist.index_matrix() for hist in hists], axis=-1), n_bins
+        )
+
+        return [FeatureMatrix(feature_mats[idx, :, :n_bins[idx] + 2]) for idx in range(len(hists))]
 
 
 class FeatureMatrix(Matrix[npt.NDArray[np.double]]):
@@ -347,15 +459,138 @@ class FeatureMatrix(Matrix[npt.NDArray[np.double]]):
         Calculate completeness or contamination estimates based on some machine learning model. (If you want both
         completeness and contamination, you have to call this function twice.)
 
-        :param model_file: An sklearn .pickle file contaning the model that should be used.
+        :param model_file: An sklearn .pickle file contaning the model that should be used. If a converted version of
+        the model with the same name but extension .onnx exists next to it and onnxruntime is installed, the ONNX model
+        is used instead.
 
         :return: An array contaning the predictions, one value for each query bin.
         """
-        mlp = pickle.load(open(model_file, "rb"))
-        return mlp.predict(self._mat)
+        model = _load_model(model_file)
+
+        # Bins with identical feature vectors get the same prediction, so we only predict each unique row once.
+        unique_mat, inverse = np.unique(self._mat, axis=0, return_inverse=True)
 
+        if isinstance(model, tuple):
+            session, input_name = model
+            predictions = session.run(None, {input_name: unique_mat.astype(np.float32)})[0].ravel()
+        else:
+            predictions = model.predict(unique_mat)
+
+        return predictions[inverse.reshape(-1)]
+
+
+class _SklearnModel(Protocol):
+    def predict(self, mat: npt.NDArray[np.double]) -> npt.NDArray[np.float32]: ...
+
+
+class _OnnxSession(Protocol):
+    def run(
+            self,
+            output_names: Optional[List[str]],
+            input_feed: Dict[str, npt.NDArray[np.float32]]
+    ) -> List[npt.NDArray[np.float32]]: ...
 
-def load_u8mat_from_file(filename: str) -> npt.NDArray[np.uint8]:
+
+def _load_model(model_file: str) -> Union[Tuple[_OnnxSession, str], _SklearnModel]:
+    """
+    Load a model for FeatureMatrix.ml_estimates. The result is cached, so repeated calls (e.g. from the web server)
+    don't need to load the model again. The modification times of the model files are part of the cache key, so an
+    updated model (e.g. after update-database) is loaded again.
+
+    :param model_file: Path to the sklearn .pickle file
+    :return: Either a tuple containing an onnxruntime InferenceSession and the name of its input or the unpickled
+    sklearn model
+    """
+    onnx_file = os.path.splitext(model_file)[0] + ".onnx"
+    onnx_mtime = os.path.getmtime(onnx_file) if os.path.isfile(onnx_file) else None
+
+    return _load_model_cached(model_file, os.path.getmtime(model_file), onnx_mtime)
+
+
+@lru_cache(maxsize=4)
+def _load_model_cached(
+        model_file: str,
+        _mtime: float,
+        _onnx_mtime: Optional[float]
+) -> Union[Tuple[_OnnxSession, str], _SklearnModel]:
+    onnx_file = os.path.splitext(model_file)[0] + ".onnx"
+
+    if os.path.isfile(onnx_file):
+        try:
+            import onnxruntime  # type: ignore
+        except ImportError:
+            pass
+        else:
+            session = onnxruntime.InferenceSession(onnx_file, providers=["CPUExecutionProvider"])
+            input_name: str = session.get_inputs()[0].name
+            return session, input_name
+
+    with open(model_file, "rb") as f:
+        model: _SklearnModel = pickle.load(f)
+    return model
+
+
+_EQ_COUNTS_CUDA = r'''
+extern "C" __global__ void eq_counts(const unsigned char* db, const unsigned char* queries, int* out,
+                                     long long num_refs, long long num_count) {
+    // One thread per (query, reference) pair. The database is in column-major order, so neighboring threads read
+    // neighboring bytes. All threads of a block belong to the same query and skip the same (inadmissible) columns.
+    long long ref = (long long) blockDim.x * blockIdx.x + threadIdx.x;
+    if (ref >= num_refs) return;
+    const unsigned char* query = queries + blockIdx.y * num_count;
+    int count = 0;
+    for (long long col = 0; col < num_count; col++) {
+        unsigned char val = query[col];
+        if (val != 0 && val != 255) count += db[col * num_refs + ref] == val;
+    }
+    out[blockIdx.y * num_refs + ref] = count;
+}
+'''
+
+
+def _nearest_neighbors_cupy(
+        db: DatabaseMatrix,
+        q_mat: npt.NDArray[np.uint8],
+        k: int,
+        query_block: int = 1024
+) -> Tuple[npt.NDArray[np.uint32], npt.NDArray[np.float32]]:
+    """
+    GPU version of `nearest_neighbors_idx_njit_mat`. Only the equality counts are calculated on the GPU; scores and
+    neighbor selection are done by the same code as on the CPU, so the results are identical.
+    """
+    import cupy
+
+    # mat_gpu returns a CuPy array as plain object (CuPy is optional), asarray doesn't copy it
+    db_gpu = cupy.asarray(db.mat_gpu())
+    # The kernel indexes the database as column-major array
+    assert db_gpu.flags.f_contiguous, "Database has to be in column-major order"
+
+    num_refs, num_count = db.mat().shape
+    k = min(k, num_refs)
+    kernel = cupy.RawKernel(_EQ_COUNTS_CUDA, "eq_counts")
+    threads = 256
+
+    knn_inds = np.zeros((q_mat.shape[0], k), dtype=np.uint32)
+    knn_scores = np.zeros(q_mat.shape[0], dtype=np.float32)
+    for q_start in range(0, q_mat.shape[0], query_block):
+        queries = np.ascontiguousarray(q_mat[q_start:q_start + query_block])
+        eq_counts = cupy.empty((queries.shape[0], num_refs), dtype=cupy.int32)
+        kernel(
+            ((num_refs + threads - 1) // threads, queries.shape[0]), (threads,),
+            (db_gpu, cupy.asarray(queries), eq_counts, np.int64(num_refs), np.int64(num_count))
+        )
+        q_norm = np.sqrt(np.count_nonzero(queries, axis=1).astype(np.float64))
+        knn_inds[q_start:q_start + query_block], knn_scores[q_start:q_start + query_block] = knn_from_eq_counts_njit(
+            cupy.asnumpy(eq_counts), db.row_norms(), q_norm, k
+        )
+
+    return knn_inds, knn_scores
+
+
+def load_u8mat_from_file(
+        filename: str,
+        mmap_mode: Optional[Literal["r+", "r", "w+", "c"]] = None
+) -> npt.NDArray[np.uint8]:
     """
     This is just a convenience function to load a numpy matrix from a file. If it doesn't suit your requirements, just
     use numpy.load or numpy.loadtxt directly.
@@ -363,6 +598,9 @@ def load_u8mat_from_file(filename: str) -> npt.NDArray[np.uint8]:
     :param filename: Filename of the matrix file. If the extension is .npy it is assumed that the content is in binary
     format. If it is .npz the file will be treated as compressed binary format contaning exactly one matrix. Otherwise
     the file will be read as csv.
+    :param mmap_mode: Memory-map the file instead of reading it into memory (see numpy.load). This only has an effect
+    for .npy files, since compressed .npz and csv files have to be read completely anyway. If you use "r", the matrix is
+    read-only.
 
     :return: The loaded matrix as a numpy array
     """
@@ -370,10 +608,12 @@ def load_u8mat_from_file(filename: str) -> npt.NDArray[np.uint8]:
 
     mat: npt.NDArray[np.uint8]
     if file_format == "npy":
-        mat = np.load(filename)
+        mat = np.load(filename, mmap_mode=mmap_mode)
     elif file_format == "npz":
-        mat = np.load(filename)["arr_0"]
+        with np.load(filename) as npz_file:
+            mat = npz_file["arr_0"]
     else:
         mat = np.loadtxt(filename, delimiter=",", dtype=np.uint8)
 
     return mat
+
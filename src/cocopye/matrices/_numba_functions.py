@@ -23,100 +23,385 @@ mostly do the actual work while the matrix classes are just wrappers around them
 from numba import njit, prange
 import numpy as np
 import numpy.typing as npt
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Union
 
 
-@njit(nogil=True, parallel=True)
-def estimates_njit(query_mat, db_mat, k, frac_eq, progress_bar, knn_inds: npt.NDArray[np.uint64]):
-    result = np.zeros((query_mat.shape[0], 3))
+@njit(nogil=True, parallel=True, cache=True)
+def estimates_njit(query_mat, db_mat, k, frac_eq, progress_bar, knn_inds: npt.NDArray[np.uint32]):
+    result = np.empty((query_mat.shape[0], 3))
 
     for idx in prange(len(query_mat)):
-        comp, cont, num = estimate_njit(db_mat, query_mat[idx], k, frac_eq, knn_inds=knn_inds[idx, :])
-        result[idx] = np.array([comp, cont, num])
+        comp, cont, num = estimate_with_knn_njit(db_mat, query_mat[idx], k, frac_eq, knn_inds[idx, :])
+        result[idx, 0] = comp
+        result[idx, 1] = cont
+        result[idx, 2] = num
         progress_bar.update(1)
 
     return result
 
 
-@njit
+@njit(nogil=True, parallel=True, cache=True)
+def preestimates_njit(mat: npt.NDArray[np.uint8], markers: npt.NDArray[np.uint32]) -> npt.NDArray[np.float32]:
+    # Completeness is the fraction of markers that are present, contamination the number of additional copies per
+    # marker. Both are counted in a single pass over the marker columns of each row (no submatrix is extracted).
+    num_markers = markers.shape[0]
+    if num_markers == 0:
+        return np.full((mat.shape[0], 2), np.nan, dtype=np.float32)
+
+    result = np.empty((mat.shape[0], 2), dtype=np.float32)
+
+    for row in prange(mat.shape[0]):
+        num_present = 0
+        num_total = 0
+        for marker in markers:
+            count = mat[row, marker]
+            num_present += count > 0
+            num_total += count
+        result[row, 0] = num_present / num_markers
+        result[row, 1] = (num_total - num_present) / num_markers
+
+    return result
+
+
+@njit(nogil=True, cache=True)
 def estimate_njit(
         mat: npt.NDArray[np.uint8],
         vec: npt.NDArray[np.uint8],
         k: int,
         frac_eq: float = 1.0,
-        knn_inds: Optional[npt.NDArray[np.uint64]] = None
+        knn_inds: Optional[npt.NDArray[np.uint32]] = None
 ) -> Tuple[float, float, int]:
     if knn_inds is None:
-        knn_mat_idx = nearest_neighbors_idx_njit(mat, vec, k)[0]
-        knn_mat = mat[knn_mat_idx, :]
+        knn_mat_idx = nearest_neighbors_idx_njit(mat, vec, k, row_norms_njit(mat))[0].astype(np.uint32)
+        return estimate_with_knn_njit(mat, vec, k, frac_eq, knn_mat_idx)
     else:
-        knn_mat = mat[knn_inds, :]
+        return estimate_with_knn_njit(mat, vec, k, frac_eq, knn_inds)
+
+
+@njit(nogil=True, cache=True)
+def estimate_with_knn_njit(
+        mat: npt.NDArray[np.uint8],
+        vec: npt.NDArray[np.uint8],
+        k: int,
+        frac_eq: float,
+        knn_inds: npt.NDArray[np.uint32]
+) -> Tuple[float, float, int]:
+    min_num_eq = round(k * frac_eq)
+    # Values of the neighbors in the current column. The neighbor rows are read directly from mat, so no k x D copy of
+    # them is made.
+    column = np.empty((knn_inds.shape[0], 1), dtype=np.uint8)
 
-    (mode_vals, mode_nums) = mode(knn_mat)
+    # Mode, marker selection and the completeness/contamination sums are calculated in a single pass over the columns
+    # (see `column_mode` for the details of the mode calculation).
+    # The calculations are done in float32, which is what numba used for the uint8 division in the vectorized version
+    # of this function. This keeps the estimates (and therefore the features for the ML models) unchanged.
+    counts = np.zeros(256, dtype=np.int32)
+    comp_sum = np.float32(0.)
+    cont_sum = np.float32(0.)
+    n_mark = 0
+    for col in range(mat.shape[1]):
+        num_nonzero = 0
+        for row in range(knn_inds.shape[0]):
+            column[row, 0] = mat[knn_inds[row], col]
+            num_nonzero += column[row, 0] != 0
+        # A marker needs a nonzero mode that occurs at least min_num_eq times. This is impossible if there are fewer
+        # nonzero values, which is the case for most (sparse) columns, so we can skip the mode calculation.
+        if num_nonzero == 0 or num_nonzero < min_num_eq:
+            continue
+        mode_val, mode_num = column_mode(column, 0, counts)
 
-    (mark_inds,) = np.where(
-        np.logical_and(np.logical_and(mode_vals > 0, mode_vals < 255), mode_nums >= round(k * frac_eq))
-    )
-    n_mark = len(mark_inds)
+        if 0 < mode_val < 255 and mode_num >= min_num_eq:
+            ratio = np.float32(vec[col]) / np.float32(mode_val)
+            comp = min(ratio, np.float32(1.))
+            comp_sum += comp
+            cont_sum += ratio - comp
+            n_mark += 1
 
     if n_mark == 0:
         return -1., -1., 0
 
-    comps = np.clip(vec[mark_inds] / mode_vals[mark_inds], 0, 1)
-    comp = np.mean(comps)
-    cont = np.mean(vec[mark_inds] / mode_vals[mark_inds] - comps)
+    return float(np.float32(comp_sum / n_mark)), float(np.float32(cont_sum / n_mark)), n_mark
 
-    return float(comp), float(cont), n_mark
 
-
-@njit(parallel=True)
+@njit(nogil=True, parallel=True, cache=True)
 def nearest_neighbors_idx_njit_mat(
         db_mat: npt.NDArray[np.uint8],
         q_mat: npt.NDArray[np.uint8],
+        k: int,
+        db_norm: npt.NDArray[np.float64],
+        query_block: int = 16
+) -> Tuple[npt.NDArray[np.uint32], npt.NDArray[np.float32]]:
+    # Same result as calling nearest_neighbors_idx_njit for each query. The database is scanned column by column, so
+    # db_mat should be in column-major (Fortran) order (see DatabaseMatrix.mat_column_major); any layout works, but
+    # a row-major matrix is much slower. For each column, the equality counts of all queries in a block for which the
+    # column is admissible (0 < count < 255) are updated at once. This way only the admissible columns (usually a
+    # small fraction) are read, each of them once per query block, and the inner loop runs over contiguous memory.
+    # db_norm are the row norms of the database (see row_norms_njit).
+    num_refs, num_count = db_mat.shape
+    num_queries = q_mat.shape[0]
+    k = min(k, num_refs)
+
+    knn_inds = np.zeros((num_queries, k), dtype=np.uint32)
+    knn_scores = np.zeros(num_queries, dtype=np.float32)
+
+    for block in prange((num_queries + query_block - 1) // query_block):
+        q_start = block * query_block
+        q_end = min(q_start + query_block, num_queries)
+
+        q_norm = np.empty(q_end - q_start)
+        for q_idx in range(q_end - q_start):
+            q_norm[q_idx] = np.sqrt((q_mat[q_start + q_idx] > 0).sum())
+
+        eq_counts = np.zeros((q_end - q_start, num_refs), dtype=np.int32)
+        for col in range(num_count):
+            column = db_mat[:, col]
+            for q_idx in range(q_end - q_start):
+                val = q_mat[q_start + q_idx, col]
+                if 0 < val < 255:
+                    eq_count = eq_counts[q_idx]
+                    for ref in range(num_refs):
+                        eq_count[ref] += column[ref] == val
+
+        knn_inds[q_start:q_end], knn_scores[q_start:q_end] = knn_from_eq_counts_njit(eq_counts, db_norm, q_norm, k)
+
+    return knn_inds, knn_scores
+
+
+@njit(nogil=True, cache=True)
+def knn_from_eq_counts_njit(
+        eq_counts: npt.NDArray[np.int32],
+        db_norm: npt.NDArray[np.float64],
+        q_norm: npt.NDArray[np.float64],
         k: int
-) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.float32]]:
-    knn_inds = np.zeros((q_mat.shape[0], k), dtype=np.uint64)
-    knn_scores = np.zeros(q_mat.shape[0], dtype=np.float32)
-    for idx in prange(q_mat.shape[0]):
-        knn_inds[idx], knn_scores[idx] = nearest_neighbors_idx_njit(db_mat, q_mat[idx], k)
+) -> Tuple[npt.NDArray[np.uint32], npt.NDArray[np.float32]]:
+    # Turns the equality counts of some queries (rows) with all database entries (columns) into scores and selects the
+    # k best neighbors of each query (or all database entries if there are less than k). This is also used for
+    # equality counts calculated on a GPU.
+    num_queries, num_refs = eq_counts.shape
+    k = min(k, num_refs)
+    knn_inds = np.zeros((num_queries, k), dtype=np.uint32)
+    knn_scores = np.zeros(num_queries, dtype=np.float32)
+
+    for q_idx in range(num_queries):
+        top_inds = np.zeros(k, dtype=np.int64)
+        top_scores = np.zeros(k)
+        num_found = 0
+        for ref in range(num_refs):
+            # Zero norms (no nonzero counts) would raise a ZeroDivisionError here, which is swallowed inside the prange
+            # of nearest_neighbors_idx_njit_mat. Such pairs get score 0, like in nearest_neighbors_idx_njit.
+            if db_norm[ref] > 0 and q_norm[q_idx] > 0:
+                score = eq_counts[q_idx, ref] / db_norm[ref] / q_norm[q_idx]
+            else:
+                score = 0.
+            num_found = insert_top_k(top_inds, top_scores, num_found, ref, score)
+
+        knn_inds[q_idx] = top_inds
+        knn_scores[q_idx] = top_scores.mean()
+
     return knn_inds, knn_scores
 
 
-@njit(parallel=True)
+@njit(nogil=True, parallel=True, cache=True)
 def nearest_neighbors_idx_njit(
         mat: npt.NDArray[np.uint8],
         vec: npt.NDArray[np.uint8],
-        k: int
+        k: int,
+        db_norm: npt.NDArray[np.float64]
 ) -> Tuple[npt.NDArray[np.int64], np.float32]:
+    # db_norm are the row norms of mat (see row_norms_njit). As they don't depend on the query, only the admissible
+    # columns of the query (0 < count < 255) have to be compared.
     num_refs, num_count = mat.shape
 
     assert vec.ndim == 1, "Vector has to be 1-dimensional"
     assert vec.shape[0] == num_count, "Vector length must be equal to the number of columns of the matrix"
 
+    # Everything that only depends on the query vector is calculated once instead of once per reference
+    cols = np.nonzero(np.logical_and(0 < vec, vec < 255))[0]
+    vals = vec[cols]
+    vec_norm = np.sqrt((vec > 0).sum())
+
     eq_counts = np.zeros(num_refs)
-    norm_vec = np.sqrt((mat > 0).sum(axis=1))
-    for idx in prange(len(mat)):
-        eq_count = np.sum(np.logical_and(np.logical_and(0 < vec, vec < 255), mat[idx] == vec))
-        eq_counts[idx] = eq_count / norm_vec[idx] / np.sqrt((vec > 0).sum())
+    for idx in prange(num_refs):
+        row = mat[idx]
+        eq_count = 0
+        for col_idx in range(cols.shape[0]):
+            eq_count += row[cols[col_idx]] == vals[col_idx]
+        # A reference or query without any nonzero count has no similarity to anything (instead of 0/0)
+        eq_counts[idx] = eq_count / db_norm[idx] / vec_norm if db_norm[idx] > 0 and vec_norm > 0 else 0.
 
-    inds = np.flip(np.argsort(eq_counts))[:k]
+    inds = top_k_idx(eq_counts, k)
 
     return inds, eq_counts[inds].mean()
 
 
-@njit
-def mode(knn_mat: npt.NDArray[np.uint8]):
-    mode_vals, mode_nums = np.zeros(knn_mat.shape[1], dtype=np.uint8),  np.zeros(knn_mat.shape[1], dtype=np.uint8)
+@njit(nogil=True, parallel=True, cache=True)
+def row_norms_njit(mat: npt.NDArray[np.uint8]) -> npt.NDArray[np.float64]:
+    # Square root of the number of nonzero counts in each row (used to normalize the nearest neighbor scores)
+    result = np.empty(mat.shape[0])
+    for row in prange(mat.shape[0]):
+        num_nonzero = 0
+        for col in range(mat.shape[1]):
+            num_nonzero += mat[row, col] > 0
+        result[row] = np.sqrt(num_nonzero)
+    return result
+
+
+@njit(cache=True)
+def top_k_idx(scores: npt.NDArray[np.float64], k: int) -> npt.NDArray[np.int64]:
+    """
+    Indices of the k largest scores in descending order. Only a sorted buffer of size k is kept, so this is linear in
+    the number of scores (instead of sorting all of them). For equal scores the smaller index comes first.
+    """
+    k = min(k, len(scores))
+    inds = np.empty(k, dtype=np.int64)
+    top_scores = np.empty(k)
+    num_found = 0
+
+    for idx in range(len(scores)):
+        num_found = insert_top_k(inds, top_scores, num_found, idx, scores[idx])
+
+    return inds
+
+
+@njit(cache=True)
+def insert_top_k(
+        top_inds: npt.NDArray[np.int64],
+        top_scores: npt.NDArray[np.float64],
+        num_found: int,
+        idx: int,
+        score: float
+) -> int:
+    """
+    Insert an index into a buffer of the (so far) best scores, which is sorted in descending order. Indices have to be
+    inserted in ascending order, so that the smaller index comes first for equal scores. Returns the new number of
+    entries in the buffer. NaN scores are treated as -inf (all comparisons with NaN are false, so a NaN in the buffer
+    would otherwise block all better scores behind it).
+    """
+    k = len(top_inds)
+    if np.isnan(score):
+        score = -np.inf
+
+    if num_found < k:
+        pos = num_found
+        num_found += 1
+    elif score > top_scores[k - 1]:
+        pos = k - 1
+    else:
+        return num_found
+
+    while pos > 0 and score > top_scores[pos - 1]:
+        top_inds[pos] = top_inds[pos - 1]
+        top_scores[pos] = top_scores[pos - 1]
+        pos -= 1
+    top_inds[pos] = idx
+    top_scores[pos] = score
+
+    return num_found
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def feature_mats_njit(
+        query_mat: npt.NDArray[np.uint8],
+        db_mat: npt.NDArray[np.uint8],
+        knn_inds: npt.NDArray[np.uint32],
+        estimates: npt.NDArray[np.float64],
+        indx_mats: npt.NDArray[Union[np.int8, np.int16]],
+        n_bins: npt.NDArray[np.int64]
+) -> npt.NDArray[np.float64]:
+    # One feature matrix for each lookup table. Each row contains the normalized histogram (n_bins[res] values)
+    # followed by the completeness and contamination estimate. Rows of resolutions with less bins are padded at the end.
+    num_res = indx_mats.shape[2]
+
+    result = np.zeros((num_res, query_mat.shape[0], n_bins.max() + 2))
+
+    for idx in prange(query_mat.shape[0]):
+        query = query_mat[idx]
+        counts = np.zeros((num_res, n_bins.max()), dtype=np.int64)
+
+        for neighbor in knn_inds[idx]:
+            row = db_mat[neighbor]
+            for col in range(query.shape[0]):
+                bins = indx_mats[query[col], row[col]]
+                for res in range(num_res):
+                    if bins[res] != -1:
+                        counts[res, bins[res]] += 1
+
+        # The mean over all neighbors normalized to a sum of 1 is the same as the normalized sum
+        for res in range(num_res):
+            total = counts[res].sum()
+            for hist_bin in range(n_bins[res]):
+                result[res, idx, hist_bin] = counts[res, hist_bin] / total if total > 0 else np.nan
+            result[res, idx, n_bins[res]] = estimates[idx, 0]
+            result[res, idx, n_bins[res] + 1] = estimates[idx, 1]
+
+    return result
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def taxonomy_njit(codes: npt.NDArray[np.int32], knn_inds: npt.NDArray[np.uint32]) -> npt.NDArray[np.int32]:
+    # For each query, find the first (most specific) rank where all neighbors have the same taxon code (and no missing
+    # value, which is -1). The result contains the code and the rank index, or -1 for both if there is no such rank.
+    result = np.full((knn_inds.shape[0], 2), -1, dtype=np.int32)
+
+    for idx in prange(knn_inds.shape[0]):
+        for rank in range(codes.shape[1]):
+            first = codes[knn_inds[idx, 0], rank]
+            consensus = first != -1
+            for neighbor in range(1, knn_inds.shape[1]):
+                if codes[knn_inds[idx, neighbor], rank] != first:
+                    consensus = False
+                    break
+            if consensus:
+                result[idx, 0] = first
+                result[idx, 1] = rank
+                break
+
+    return result
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def count_ones_per_col_njit(mat: npt.NDArray[np.uint8], col_block: int = 4096) -> npt.NDArray[np.int64]:
+    # Each thread sweeps row by row over its own block of columns, so the matrix is read sequentially and no two threads
+    # write to the same counter.
+    num_rows, num_cols = mat.shape
+    result = np.zeros(num_cols, dtype=np.int64)
+
+    for block in prange((num_cols + col_block - 1) // col_block):
+        start = block * col_block
+        end = min(start + col_block, num_cols)
+        for row in range(num_rows):
+            for col in range(start, end):
+                result[col] += mat[row, col] == 1
+
+    return result
+
+
+@njit(cache=True)
+def column_mode(knn_mat: npt.NDArray[np.uint8], col: int, counts: npt.NDArray[np.int32]) -> Tuple[int, int]:
+    # Mode of a single column, counted in a fixed 256-entry buffer (one entry per possible value) that is reused for all
+    # columns. The counts are int32, so they can't overflow even if there are more than 255 neighbors. Only the entries
+    # that were incremented are reset afterwards, so the buffer has to be all zeros before the first call. Like argmax
+    # over a bincount, the smallest value wins in case of a tie.
+    num_rows = knn_mat.shape[0]
+    for row in range(num_rows):
+        counts[knn_mat[row, col]] += 1
+
+    best_val = 0
+    best_num = 0
+    for row in range(num_rows):
+        val = knn_mat[row, col]
+        num = counts[val]
+        if num > best_num or (num == best_num and val < best_val):
+            best_val = val
+            best_num = num
 
-    for idx, arr in enumerate(knn_mat.T):
-        counts = np.bincount(arr)
-        mode_vals[idx] = np.argmax(counts)
-        mode_nums[idx] = np.max(counts)
+    for row in range(num_rows):
+        counts[knn_mat[row, col]] = 0
 
-    return mode_vals, mode_nums
+    return best_val, best_num
 
 
-@njit
+@njit(nogil=True, cache=True)
 def mean_ax0(mat):
     result = np.zeros(mat.shape[1])
     for idx, col in enumerate(mat.T):
@@ -125,7 +410,7 @@ def mean_ax0(mat):
     return result
 
 
-@njit
+@njit(nogil=True, cache=True)
 def std_ax0(mat):
     result = np.zeros(mat.shape[1])
     for idx, col in enumerate(mat.T):
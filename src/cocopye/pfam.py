@@ -17,14 +17,15 @@
 
 import _io
 import os
+import queue
 import subprocess
+import threading
 from datetime import datetime
 from multiprocessing.pool import ThreadPool
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Dict, Optional, IO
 
 import numpy as np
 import numpy.typing as npt
-from Bio import SeqIO
 from tqdm import tqdm
 
 MAX_PFAM = 17126
@@ -52,90 +53,252 @@ def count_pfams(
     :param file_extensions: A list of allowed file extensions of the input FASTA files. Probably something like .fna or
     .fasta. Each file in the bin folder that has on of these extensions is considered a bin.
     :param num_threads: Number of threads that UProC should use. It is possible (and likely) that UProC ignores this
-    parameter, but you can try.
+    parameter, but you can try. This is also the maximal number of uproc-orf processes that run in parallel.
     :param print_progress: Print a progress bar to stdout
     :return: A 3-tuple. The first element is a QueryMatrix containing the Pfam counts. Each row represents a bin
     and each column a Pfam. The second element is a list of bin names (names of the input FASTA files without file
     extension) in the same order as they appear in the QueryMatrix. The third element is a list of count-ratios of the
     input bins (number of pfams divided by bin size).
     """
-    bins = [file for file in os.listdir(bin_folder) if file.rpartition(".")[2] in file_extensions]
+    bins = bin_files(bin_folder, file_extensions)
 
     if len(bins) == 0:
         return None
 
-    process_orf = subprocess.Popen(
-        orf_bin, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
-    )
-
-    assert process_orf.stdin is not None  # MyPy
+    # uproc-orf is single-threaded, so we run several instances on different bins and merge their output into a single
+    # uproc-prot process. This way the (large) Pfam database is still loaded only once.
+    num_orf_processes = max(1, min(int(num_threads), len(bins)))
 
     process_prot = subprocess.Popen(
         [prot_bin, "-p", "-F", "hf", "-t", str(num_threads), pfam_dir, model_dir],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=process_orf.stdout
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE
     )
 
+    assert process_prot.stdin is not None  # MyPy
+
     count_pfams_async = ThreadPool(processes=1).apply_async(_count_pfams, (process_prot.stdout,))
 
-    lengths = {}
+    lengths: Dict[str, int] = {}
+    bin_queue: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+    for bin_file in bins:
+        bin_queue.put(bin_file)
 
-    for bin_file in tqdm(
-            bins,
+    prot_stdin_lock = threading.Lock()
+
+    with tqdm(
+            total=len(bins),
             ncols=0,
             desc="\033[0;37m[" + str(datetime.now()) + "]\033[0m Counting Pfams",
             disable=not print_progress
-    ):
-        bin_id = bin_file.rpartition(".")[0]
-        lengths[bin_id] = 0
-        for record in SeqIO.parse(os.path.join(bin_folder, bin_file), "fasta"):
-            lengths[bin_id] += len(str(record.seq))
-            process_orf.stdin.write(">" + bin_id + "$$" + record.id + "\n")
-            process_orf.stdin.write(str(record.seq) + "\n")
+    ) as progress_bar, ThreadPool(processes=2 * num_orf_processes) as pool:
+        tasks = []
+        for _ in range(num_orf_processes):
+            process_orf = subprocess.Popen(orf_bin, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            tasks.append(pool.apply_async(
+                _write_bins, (process_orf, bin_folder, bin_queue, lengths, progress_bar)
+            ))
+            tasks.append(pool.apply_async(
+                _forward_records, (process_orf, process_prot.stdin, prot_stdin_lock)
+            ))
+
+        for task in tasks:
+            task.get()
 
-    process_orf.stdin.close()
-    process_orf.wait()
+    try:
+        process_prot.stdin.close()
+    except BrokenPipeError:
+        pass  # uproc-prot failed, see below
 
     pfam_counts, sequences, total_counts = count_pfams_async.get()
-    count_ratio = [total_counts[seq] / lengths[seq] for seq in sequences]
 
-    result, errors = process_prot.communicate()
+    assert process_prot.stderr is not None  # MyPy
+    errors = process_prot.stderr.read()
 
-    if process_prot.returncode != 0:
+    if process_prot.wait() != 0:
         raise Exception(errors)
 
+    # The output order of the ORF processes is arbitrary, so we restore the order of the input files.
+    bin_order = {bin_file.rpartition(".")[0]: idx for idx, bin_file in enumerate(bins)}
+    order = sorted(range(len(sequences)), key=lambda idx: bin_order[sequences[idx]])
+    pfam_counts = pfam_counts[order]
+    sequences = [sequences[idx] for idx in order]
+
+    count_ratio = [total_counts[seq] / lengths[seq] for seq in sequences]
+
     return pfam_counts, sequences, count_ratio
 
 
+def _write_bins(
+        process_orf: "subprocess.Popen[bytes]",
+        bin_folder: str,
+        bin_queue: "queue.SimpleQueue[str]",
+        lengths: Dict[str, int],
+        progress_bar: tqdm
+) -> None:
+    """
+    Write bins from the queue to the stdin of an uproc-orf process until the queue is empty. The bin id is prepended to
+    each sequence header, so that the results can be assigned to the correct bin later.
+    """
+    assert process_orf.stdin is not None  # MyPy
+
+    try:
+        while True:
+            try:
+                bin_file = bin_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            bin_id = bin_file.rpartition(".")[0]
+            lengths[bin_id] = _write_fasta(os.path.join(bin_folder, bin_file), bin_id, process_orf.stdin)
+
+            progress_bar.update(1)
+    finally:
+        process_orf.stdin.close()
+
+
+def _write_fasta(fasta_file: str, bin_id: str, stdin: IO[bytes], buffer_size: int = 1 << 20) -> int:
+    """
+    Write the records of a FASTA file to the stdin of an uproc-orf process (one line per sequence, bin id prepended to
+    the sequence id) and return the total sequence length. The file is parsed on the byte level in the same way as
+    Biopython's FASTA parser, but without creating a record object for each contig, and the output is written in
+    chunks of about `buffer_size` bytes.
+    """
+    prefix = b">" + bin_id.encode() + b"$$"
+    buffer = bytearray()
+    length = 0
+    in_record = False
+
+    with open(fasta_file, "rb") as file:
+        for line in file:
+            if line[:1] == b">":
+                if in_record:
+                    buffer += b"\n"
+                title = line[1:].strip()
+                buffer += prefix + (title.split(None, 1)[0] if len(title) > 0 else b"") + b"\n"
+                in_record = True
+            elif in_record:
+                # Like Biopython, ignore line breaks and spaces inside the sequence
+                seq = line.rstrip().replace(b" ", b"")
+                buffer += seq
+                length += len(seq)
+
+            if len(buffer) >= buffer_size:
+                stdin.write(buffer)
+                buffer.clear()
+
+    if in_record:
+        buffer += b"\n"
+    stdin.write(buffer)
+
+    return length
+
+
+def _forward_records(
+        process_orf: "subprocess.Popen[bytes]",
+        prot_stdin: IO[bytes],
+        lock: threading.Lock,
+        chunk_size: int = 1 << 16
+) -> None:
+    """
+    Forward the output of an uproc-orf process to uproc-prot. Several ORF processes share the same uproc-prot stdin, so
+    we only write complete FASTA records while holding the lock.
+    """
+    orf_stdout = process_orf.stdout
+    assert orf_stdout is not None  # MyPy
+
+    rest = b""
+    prot_running = True
+    for chunk in iter(lambda: orf_stdout.read(chunk_size), b""):
+        data = rest + chunk
+        cut = data.rfind(b"\n>") + 1
+        if cut > 0 and prot_running:
+            prot_running = _write_locked(prot_stdin, data[:cut], lock)
+        rest = data[cut:] if prot_running else b""
+
+    if len(rest) > 0 and prot_running:
+        _write_locked(prot_stdin, rest, lock)
+
+    if process_orf.wait() != 0:
+        raise Exception("uproc-orf exited with return code " + str(process_orf.returncode))
+
+
+def _write_locked(stdin: IO[bytes], data: bytes, lock: threading.Lock) -> bool:
+    """
+    Write data to the (shared) stdin of uproc-prot. Returns False if uproc-prot has already exited. In this case the
+    remaining ORF output is only drained (so that uproc-orf doesn't block) and `count_pfams` raises an exception with
+    the error message of uproc-prot.
+    """
+    try:
+        with lock:
+            stdin.write(data)
+        return True
+    except BrokenPipeError:
+        return False
+
+
+def bin_files(bin_folder: str, file_extensions: List[str]) -> List[str]:
+    """
+    List all files in a folder that are considered as input bins by `count_pfams`.
+
+    :param bin_folder: Folder containing input bins in FASTA format
+    :param file_extensions: A list of allowed file extensions
+    :return: A list of filenames (without the folder)
+    """
+    extensions = set(file_extensions)
+    with os.scandir(bin_folder) as entries:
+        return [entry.name for entry in entries if entry.name.rpartition(".")[2] in extensions and entry.is_file()]
+
+
 def _count_pfams(
         stdout: _io.BufferedReader,
-        merge: bool = True
+        merge: bool = True,
+        chunk_size: int = 1 << 20
 ) -> Tuple[npt.NDArray[np.uint8], List[str], Dict[str, int]]:
-    pfams: Dict[str, List[int]] = {}
-    sequences = []
-
-    for line in iter(stdout.readline, ''):
-        line = line.decode("utf-8")
-        if line == "":
-            break
-
-        seq, pfam = line.split(",")[:2]
-        if merge:
-            seq = seq.rpartition("$$")[0]
-        pfam = int(pfam.strip()[2:])
+    # The output is read in large blocks and parsed as bytes. Only the sequence names are decoded (once per sequence
+    # instead of once per hit).
+    seq_rows: Dict[bytes, int] = {}
+    # One entry per Pfam hit; the counts are calculated afterwards for all hits at once
+    hit_rows: List[int] = []
+    hit_pfams: List[int] = []
 
-        if seq not in pfams:
-            pfams[seq] = []
-            sequences.append(seq)
+    rest = b""
+    for chunk in iter(lambda: stdout.read(chunk_size), b""):
+        *lines, rest = (rest + chunk).split(b"\n")
+        _parse_hits(lines, merge, seq_rows, hit_rows, hit_pfams)
+    _parse_hits([rest], merge, seq_rows, hit_rows, hit_pfams)
 
-        pfams[seq].append(pfam)
+    sequences = [seq.decode("utf-8") for seq in seq_rows]
 
+    rows = np.array(hit_rows, dtype=np.int64)
     count_mat = np.zeros((len(sequences), MAX_PFAM + 1), dtype=np.uint8)
-    for idx, seq in enumerate(sequences):
-        for pfam in pfams[seq]:
-            if count_mat[idx, pfam] == 255:
-                continue
-            count_mat[idx, pfam] += 1
+    # Number of hits for each (sequence, Pfam) pair, saturated at 255
+    cells, counts = np.unique(rows * (MAX_PFAM + 1) + np.array(hit_pfams, dtype=np.int64), return_counts=True)
+    count_mat.reshape(-1)[cells] = np.minimum(counts, 255)
 
-    total_counts = {key: len(pfams[key]) for key in pfams}
+    num_hits = np.bincount(rows, minlength=len(sequences))
+    total_counts = {seq: int(num_hits[row]) for row, seq in enumerate(sequences)}
 
     return count_mat, sequences, total_counts
+
+
+def _parse_hits(
+        lines: List[bytes],
+        merge: bool,
+        seq_rows: Dict[bytes, int],
+        hit_rows: List[int],
+        hit_pfams: List[int]
+) -> None:
+    for line in lines:
+        if len(line) == 0:
+            continue
+
+        seq, pfam = line.split(b",", 2)[:2]
+        if merge:
+            seq = seq.rpartition(b"$$")[0]
+
+        row = seq_rows.get(seq)
+        if row is None:
+            row = seq_rows[seq] = len(seq_rows)
+
+        hit_rows.append(row)
+        hit_pfams.append(int(pfam.strip()[2:]))
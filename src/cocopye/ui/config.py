@@ -22,7 +22,6 @@ import argparse
 from importlib import resources
 from typing import Tuple
 
-import numba
 from appdirs import user_config_dir, user_cache_dir, user_log_dir
 from tomlkit import parse, dumps, TOMLDocument
 
@@ -35,6 +34,16 @@ CONFIG: TOMLDocument
 """Description"""
 
 
+def _default_num_threads() -> int:
+    # Same default as numba.config.NUMBA_NUM_THREADS, but without importing numba (which takes quite some time) just to
+    # parse the command line arguments.
+    if "NUMBA_NUM_THREADS" in os.environ:
+        return int(os.environ["NUMBA_NUM_THREADS"])
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
 def init() -> None:
     global ARGS, CONFIG_FILE, CONFIG
     CONFIG_FILE, CONFIG = parse_config()
@@ -70,12 +79,15 @@ def parse_args() -> argparse.Namespace:
                             help="Output file (default: cocopye_output.csv)")
     run_parser.add_argument("--file-extensions", default="fasta,fna,fa",
                             help="Allowed file extensions for the FASTA files (default: fasta,fna,fa)")
-    run_parser.add_argument("-t", "--threads", default=str(min(8, numba.config.NUMBA_NUM_THREADS)),
+    run_parser.add_argument("-t", "--threads", default=str(min(8, _default_num_threads())),
                             help="Number of threads")
     run_parser.add_argument("-v", "--verbosity", default="standard",
                             help="Output verbosity (standard, extended, full; default: standard)")
     run_parser.add_argument("--pfam24", action='store_true', dest="pfam24_run",
                             help="Use Pfam database version 24 (instead of 28)")
+    run_parser.add_argument("--cache", action='store_true',
+                            help="Cache the Pfam counts of the input files and reuse them in later runs on the same "
+                                 "(unchanged) files")
 
     # Subparser database
 
@@ -89,7 +101,7 @@ def parse_args() -> argparse.Namespace:
         db_parser.add_argument("-i", "--infolder", required=True)
         db_parser.add_argument("-m", "--metadata", required=True)
         db_parser.add_argument("-o", "--outfolder", required=True)
-        db_parser.add_argument("-t", "--threads", default=str(min(8, numba.config.NUMBA_NUM_THREADS)),
+        db_parser.add_argument("-t", "--threads", default=str(min(8, _default_num_threads())),
                                help="Number of threads")
 
     # Subparser toolbox
@@ -19,23 +19,16 @@ import os
 import shutil
 import subprocess
 import sys
+import importlib.metadata
 import importlib.util
 import tempfile
 
-import numpy as np
-import pandas as pd
-import pkg_resources
-
 from appdirs import user_data_dir, user_config_dir
-from numba import set_num_threads
 
 from .. import config
-from ..external import check_and_download_dependencies
-from ..external.data import update_cocopye_db
-from ...core import log
-from ...matrices import DatabaseMatrix
-from ...pfam import count_pfams
-from ... import constants, core
+
+# Everything else (numpy, pandas, numba, ...) is imported only where it is needed, so that simple commands like
+# 'cocopye -h' don't have to wait for the scientific Python stack to load.
 
 
 def main() -> None:
@@ -43,9 +36,9 @@ def main() -> None:
     Entry point of the terminal user interface. This is called by `src/cli.py`.
     """
     try:
-        print("Welcome to CoCoPyE v" + pkg_resources.get_distribution('CoCoPyE').version + ".\n")
-        os.environ["COCOPYE_VERSION"] = pkg_resources.get_distribution('CoCoPyE').version
-    except pkg_resources.DistributionNotFound:
+        print("Welcome to CoCoPyE v" + importlib.metadata.version('CoCoPyE') + ".\n")
+        os.environ["COCOPYE_VERSION"] = importlib.metadata.version('CoCoPyE')
+    except importlib.metadata.PackageNotFoundError:
         print("Welcome to CoCoPyE.\n")
         os.environ["COCOPYE_VERSION"] = "0.0.0"
 
@@ -55,10 +48,15 @@ def main() -> None:
     os.environ["COCOPYE_PFAMVERSION"] = "24" if config.ARGS.pfam24 else "28"
 
     if config.ARGS.subcommand in ["run", "database"]:
+        from numba import set_num_threads
         set_num_threads(int(config.ARGS.threads))
 
+    from ..external import check_and_download_dependencies
+
     if config.ARGS.subcommand == "setup":
         if config.ARGS.subcommand_setup == "update-database":
+            from ..external.data import update_cocopye_db
+            from ... import constants
             update_cocopye_db(constants.COCOPYE_DB, config.CONFIG["external"]["cocopye_db"])
             sys.exit(0)
         if config.ARGS.subcommand_setup == "cleanup":
@@ -125,6 +123,12 @@ def web():
 
 
 def create_database() -> None:
+    import numpy as np
+    import pandas as pd
+
+    from ...matrices import DatabaseMatrix
+    from ...pfam import count_pfams
+
     count_mat, seq_list, _ = count_pfams(
         config.CONFIG["external"]["uproc_orf_bin"],
         config.CONFIG["external"]["uproc_prot_bin"],
@@ -153,9 +157,13 @@ def create_database() -> None:
         np.save(os.path.join(config.ARGS.outfolder, "universal_" + superkingdom + ".npy"), all_markers[superkingdom])
     np.savez_compressed(os.path.join(config.ARGS.outfolder, "count_matrix.npz"), count_mat)
     metadata.to_csv(os.path.join(config.ARGS.outfolder, "metadata.csv"), sep=",", index=False)
+    if importlib.util.find_spec("pyarrow") is not None:
+        metadata.to_parquet(os.path.join(config.ARGS.outfolder, "metadata.parquet"), engine="pyarrow", index=False)
 
 
 def run():
+    from ... import core
+
     results = core.core(config.CONFIG["external"]["cocopye_db"],
                         config.CONFIG["external"]["uproc_orf_bin"],
                         config.CONFIG["external"]["uproc_prot_bin"],
@@ -164,26 +172,12 @@ def run():
                         config.ARGS.infolder,
                         24 if config.ARGS.pfam24 else 28,
                         config.ARGS.file_extensions.split(","),
-                        config.ARGS.threads
+                        config.ARGS.threads,
+                        use_cache=config.ARGS.cache
                         )
 
-    log("Saving results to file")
-    outfile = open(config.ARGS.outfile, "w")
-
-    if config.ARGS.verbosity == "full":
-        outfile.write("bin,stage,method,1_completeness_arc,1_contamination_arc,1_completeness_bac,1_contamination_bac,"
-                      "2_completeness,2_contamination,2_num_markers,3_completeness,3_contamination,"
-                      "coding_density,knn_score,taxonomy,taxonomy_level,notes\n")
-    elif config.ARGS.verbosity == "extended":
-        outfile.write("bin,completeness,contamination,stage,method,num_markers,coding_density,knn_score,"
-                      "taxonomy,taxonomy_level,notes\n")
-    else:
-        outfile.write("bin,completeness,contamination,method,taxonomy,taxonomy_level,notes\n")
-
-    for result in results:
-        outfile.write(result.to_csv(config.ARGS.verbosity) + "\n")
-
-    outfile.close()
+    core.log("Saving results to file")
+    results.write_csv(config.ARGS.outfile, config.ARGS.verbosity)
 
 
 def cleanup() -> None:
@@ -23,7 +23,7 @@ import os
 import subprocess
 import werkzeug
 
-from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from fastapi import FastAPI, UploadFile, Request, WebSocket
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
@@ -37,6 +37,8 @@ from ..config import parse_config
 
 CONFIG = parse_config()[1]
 
+VALID_BASES = set("ACGTNacgtn")
+
 app = FastAPI()
 jinja_env = Environment(
     loader=PackageLoader("cocopye.ui.web"),
@@ -144,10 +146,13 @@ def invalid_fasta(file_path):
     invalid = False
 
     try:
-        for record in SeqIO.parse(file_path, "fasta"):
-            empty = False
-            if any(c not in "ACGTNacgtn" for c in record.seq):
-                invalid = True
+        with open(file_path) as fasta_file:
+            # SimpleFastaParser only yields (title, sequence) strings, so no SeqRecord has to be created for each contig
+            for _, seq in SimpleFastaParser(fasta_file):  # type: ignore[no-untyped-call]
+                empty = False
+                if not set(seq) <= VALID_BASES:
+                    invalid = True
+                    break
     except Exception:
         invalid = True
 
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from cocopye.matrices import DatabaseMatrix, QueryMatrix, _nearest_neighbors_cupy
+from cocopye.matrices._numba_functions import nearest_neighbors_idx_njit_mat
+
+cupy = pytest.importorskip("cupy")
+
+
+def _random_counts(rng: np.random.Generator, num_rows: int, num_cols: int) -> np.ndarray:
+    # Mostly zeros and small counts like real Pfam counts, plus a few saturated (inadmissible) values
+    counts = rng.choice([0, 0, 0, 1, 1, 2, 3, 255], size=(num_rows, num_cols)).astype(np.uint8)
+    counts[:, 0] = 1  # no empty rows
+    return counts
+
+
+@pytest.mark.parametrize("query_block", [1024, 7])
+def test_nearest_neighbors_cupy_matches_cpu(query_block: int) -> None:
+    rng = np.random.default_rng(0)
+    db = DatabaseMatrix(_random_counts(rng, 500, 300))
+    queries = _random_counts(rng, 40, 300)
+    k = 9
+
+    cpu_inds, cpu_scores = nearest_neighbors_idx_njit_mat(db.mat_column_major(), queries, k, db.row_norms())
+    gpu_inds, gpu_scores = _nearest_neighbors_cupy(db, queries, k, query_block=query_block)
+
+    np.testing.assert_array_equal(gpu_inds, cpu_inds)
+    np.testing.assert_array_equal(gpu_scores, cpu_scores)
+
+
+def test_with_database_use_gpu() -> None:
+    rng = np.random.default_rng(1)
+    db = DatabaseMatrix(_random_counts(rng, 200, 100))
+    queries = _random_counts(rng, 10, 100)
+
+    cpu = QueryMatrix(queries).with_database(db, 5)
+    gpu = QueryMatrix(queries).with_database(db, 5, use_gpu=True)
+
+    np.testing.assert_array_equal(gpu.knn()[1], cpu.knn()[1])
+    np.testing.assert_array_equal(gpu.knn_scores(), cpu.knn_scores())
+    assert db.mat_gpu().flags.f_contiguous
@@ -0,0 +1,46 @@
+import numpy as np
+
+from cocopye.matrices import DatabaseMatrix, QueryMatrix
+from cocopye.matrices._numba_functions import top_k_idx
+
+
+def test_top_k_idx_ignores_nan() -> None:
+    scores = np.array([0.1, np.nan, 0.2, 0.9, 0.8])
+    np.testing.assert_array_equal(top_k_idx(scores, 2), [3, 4])
+    np.testing.assert_array_equal(top_k_idx(scores, 5), [3, 4, 2, 0, 1])
+
+
+def test_nearest_neighbors_idx_with_empty_reference() -> None:
+    rng = np.random.default_rng(0)
+    mat = rng.integers(1, 4, size=(30, 50)).astype(np.uint8)
+    mat[0] = 0
+    db = DatabaseMatrix(mat)
+
+    # The query is identical to reference 7, so it has to be the nearest neighbor; the empty reference is never one
+    inds = db.nearest_neighbors_idx(mat[7], 9)
+    assert inds[0] == 7
+    assert 0 not in inds
+
+
+def test_with_database_empty_rows() -> None:
+    rng = np.random.default_rng(1)
+    db_mat = rng.integers(0, 4, size=(40, 60)).astype(np.uint8)
+    db_mat[3] = 0
+    queries = rng.integers(0, 4, size=(25, 60)).astype(np.uint8)
+    queries[5] = 0
+    db = DatabaseMatrix(db_mat)
+
+    query_mat = QueryMatrix(queries).with_database(db, 9)
+    knn_inds = query_mat.knn()[1]
+    knn_scores = query_mat.knn_scores()
+
+    # Every other query gets the same neighbors as in the single-query search, and the empty reference is never one
+    for q_idx in range(queries.shape[0]):
+        if q_idx == 5:
+            continue
+        np.testing.assert_array_equal(knn_inds[q_idx], db.nearest_neighbors_idx(queries[q_idx], 9))
+        assert 3 not in knn_inds[q_idx]
+        assert knn_scores[q_idx] > 0
+
+    # The empty query has no similarity to any reference
+    assert knn_scores[5] == 0